@@ -2,10 +2,9 @@
 
 import argparse
 import os
-import random
+import secrets
 import signal
 import sys
-import string
 
 from paho.mqtt import client as mqtt
 
@@ -56,6 +55,14 @@ def arg_parser(arguments_passed: bool) -> argparse:
                                help='Continue playing the file from the beginning once the end of reached, '
                                     'instead of exiting the program')
 
+    control_group.add_argument('--from', dest='from_time', type=float, default=0,
+                               metavar='SECONDS',
+                               help='Start the playback this many seconds into the recording')
+
+    control_group.add_argument('-Q', '--qos', type=int, default=0, choices=[0, 1, 2],
+                               help='QoS level to use when publishing messages in play mode. '
+                                    'Defaults to 0')
+
     control_group.add_argument('-q', '--quiet', action='store_true',
                                help='Quiet mode, does not print out progress info. '
                                     'Useful for running as a background process')
@@ -167,7 +174,7 @@ class App:
                   file=sys.stderr)
 
 
-        random_str = ''.join(random.choice(string.ascii_letters) for _ in range(32))
+        random_str = secrets.token_hex(16)
         mqtt_client = mqtt.Client(f'MQTT-bag-{random_str}')
 
         # Set up MQTT connection
@@ -210,19 +217,26 @@ class App:
         elif args.play:
 
             self.mqtt_class = MqttPlayer(
-                mqtt_file, topics_flat, no_topics_flat, 
-                mqtt_client, quiet=args.quiet)
+                mqtt_file, topics_flat, no_topics_flat,
+                mqtt_client, qos=args.qos, from_time=args.from_time,
+                quiet=args.quiet)
 
         elif args.info:
 
             self.mqtt_class = MqttPlayer(
-                mqtt_file, topics_flat, no_topics_flat, 
+                mqtt_file, topics_flat, no_topics_flat,
                 mqtt_client, quiet=args.quiet, info_mode=True)
 
         # Finally run MQTT record / play
 
         ret = 0
 
+        # In play mode, run paho's network loop in the background: published
+        # messages are then flushed to the socket in batches by the loop
+        # thread, and broker acknowledgements (QoS > 0) are actually read
+        if args.play:
+            mqtt_client.loop_start()
+
         if args.play and args.loop:
             while (not self.terminate and ret == 0):
                 self.mqtt_class.reset()
@@ -230,6 +244,9 @@ class App:
         else:
             ret = self.mqtt_class.run()
 
+        if args.play:
+            mqtt_client.loop_stop()
+
         return ret
 
 
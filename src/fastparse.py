@@ -0,0 +1,254 @@
+import struct
+from array import array
+
+# Numba (and NumPy, which it builds on) are optional: when they are
+# installed the index scan runs as native code, otherwise the pure
+# Python scan below is used
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+    njit = None
+
+# Identifiers of the supported file format versions. They differ only in
+# the frame timestamp encoding: version 1.1 stores integer nanoseconds
+# from the monotonic clock, version 1.0 stored float seconds. New
+# recordings are written as version 1.1
+FILE_MAGIC = b'MQTTv1.1'
+FILE_MAGIC_V1_0 = b'MQTTv1.0'
+
+# Layout of the file header: identifier, message count, duration in seconds
+FILE_HDR = struct.Struct('<8sQd')
+
+# Size of the file header, in bytes
+HEADER_SIZE = 24
+
+# Size of an entry header (entry length, timestamp, topic length), in bytes
+ENTRY_HDR_SIZE = 16
+
+# Precompiled entry headers (entry length, timestamp, topic length),
+# one per timestamp encoding
+ENTRY_HDR_NS = struct.Struct('<IqI')
+ENTRY_HDR_S = struct.Struct('<IdI')
+
+# Nanoseconds to seconds
+NS_TO_S = 1e-9
+
+# Suffix and identifier of the index sidecar file written next to a recording
+IDX_SUFFIX = '.idx'
+IDX_MAGIC = b'MQTTi1.0'
+
+# Index record: entry offset, timestamp, topic id, payload length
+IDX_REC = struct.Struct('<QdII')
+
+
+def scan(buf: object) -> tuple:
+    """
+    Scans a recording in a single pass and builds index arrays of its entries
+
+    Only the entry headers are read, the payloads are skipped over, so the
+    cost of the scan does not depend on the size of the stored messages.
+    If Numba is installed, the scan is JIT compiled to native code.
+
+    Args:
+        buf (object): Buffer holding the whole recording, e.g. a memory-mapped
+                      MQTT file
+
+    Returns:
+        tuple: (offsets, timestamps, topic_lens, msg_lens) arrays with one
+               element per entry. Timestamps are always in seconds,
+               regardless of the file format version. Offsets point at the
+               entry length field, so the topic name of entry i starts at
+               offsets[i] + ENTRY_HDR_SIZE
+    """
+
+    ns_timestamps = bytes(buf[:8]) == FILE_MAGIC
+
+    if njit is not None:
+        msg_count, = struct.unpack_from('<Q', buf, 8)
+
+        # A zero count means the header was never finalized (e.g. the
+        # recorder was killed), the Python scan handles that fine
+        if msg_count > 0:
+            arr = np.frombuffer(buf, dtype=np.uint8)
+
+            offsets = np.empty(msg_count, np.int64)
+            timestamps = np.empty(msg_count, np.float64)
+            topic_lens = np.empty(msg_count, np.int64)
+            msg_lens = np.empty(msg_count, np.int64)
+
+            n = _scan_native(arr, ns_timestamps,
+                             offsets, timestamps, topic_lens, msg_lens)
+            return offsets[:n], timestamps[:n], topic_lens[:n], msg_lens[:n]
+
+    return _scan_python(buf, ns_timestamps)
+
+
+def _scan_python(buf: object, ns_timestamps: bool) -> tuple:
+    """
+    Pure Python implementation of scan(), see above
+    """
+
+    offsets = array('q')
+    timestamps = array('d')
+    topic_lens = array('l')
+    msg_lens = array('l')
+
+    if ns_timestamps:
+        unpack = ENTRY_HDR_NS.unpack_from
+        ts_scale = NS_TO_S
+    else:
+        unpack = ENTRY_HDR_S.unpack_from
+        ts_scale = 1.0
+
+    file_len = len(buf)
+    pos = HEADER_SIZE
+
+    while pos < file_len:
+        mqtt_len, timestamp, topic_len = unpack(buf, pos)
+
+        offsets.append(pos)
+        timestamps.append(timestamp * ts_scale)
+        topic_lens.append(topic_len)
+        msg_lens.append(mqtt_len - 8 - 4 - topic_len - 4)
+
+        pos += 4 + mqtt_len
+
+    return offsets, timestamps, topic_lens, msg_lens
+
+
+def write_index(mqtt_file: str, topics: list, records: bytes, count: int) -> None:
+    """
+    Writes the index sidecar file next to a recording
+
+    The sidecar stores the topic name table followed by one IDX_REC record
+    per entry, so topic summaries and seeking by timestamp do not need to
+    re-scan the recording itself.
+
+    Args:
+        mqtt_file (str): Path of the recording the index belongs to
+        topics (list): Topic names, in topic-id order
+        records (bytes): Packed IDX_REC records, one per entry
+        count (int): Number of records
+    """
+
+    with open(mqtt_file + IDX_SUFFIX, 'wb') as fp:
+        fp.write(IDX_MAGIC)
+        fp.write(struct.pack('<I', len(topics)))
+
+        for topic in topics:
+            topic_bs = topic.encode('iso-8859-15')
+            fp.write(struct.pack('<I', len(topic_bs)))
+            fp.write(topic_bs)
+
+        fp.write(struct.pack('<Q', count))
+        fp.write(records)
+
+
+def load_index(mqtt_file: str) -> tuple:
+    """
+    Loads the index sidecar of a recording, if one exists
+
+    Args:
+        mqtt_file (str): Path of the recording the index belongs to
+
+    Returns:
+        tuple: (topics, offsets, timestamps, topic_ids, msg_lens) where
+               topics is a list of topic names indexed by topic id and the
+               rest are arrays with one element per entry.
+               None if there is no usable index file
+    """
+
+    try:
+        with open(mqtt_file + IDX_SUFFIX, 'rb') as fp:
+            data = fp.read()
+    except (FileNotFoundError, IOError):
+        return None
+
+    if not data.startswith(IDX_MAGIC):
+        return None
+
+    pos = len(IDX_MAGIC)
+
+    topic_count, = struct.unpack_from('<I', data, pos)
+    pos += 4
+
+    topics = []
+    for _ in range(topic_count):
+        topic_len, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        topics.append(data[pos:pos + topic_len].decode('iso-8859-15'))
+        pos += topic_len
+
+    count, = struct.unpack_from('<Q', data, pos)
+    pos += 8
+
+    # A truncated index is useless, better to fall back to a full scan
+    if pos + count * IDX_REC.size > len(data):
+        return None
+
+    offsets = array('q')
+    timestamps = array('d')
+    topic_ids = array('l')
+    msg_lens = array('l')
+
+    records = data[pos:pos + count * IDX_REC.size]
+    for offset, timestamp, topic_id, msg_len in IDX_REC.iter_unpack(records):
+        offsets.append(offset)
+        timestamps.append(timestamp)
+        topic_ids.append(topic_id)
+        msg_lens.append(msg_len)
+
+    return topics, offsets, timestamps, topic_ids, msg_lens
+
+
+if njit is not None:
+
+    @njit(cache=True, nogil=True)
+    def _scan_native(buf, ns_timestamps, offsets, timestamps, topic_lens, msg_lens):  # pragma: no cover
+        """
+        Native implementation of the scan loop, filling the preallocated
+        output arrays and returning the number of entries found
+        """
+
+        ts_bits = np.empty(1, np.uint64)
+        ts_float = ts_bits.view(np.float64)
+
+        file_len = buf.shape[0]
+        capacity = offsets.shape[0]
+
+        pos = HEADER_SIZE
+        n = 0
+
+        while pos + ENTRY_HDR_SIZE <= file_len and n < capacity:
+
+            # Entry length (little-endian u32)
+            mqtt_len = (int(buf[pos]) | int(buf[pos + 1]) << 8 |
+                        int(buf[pos + 2]) << 16 | int(buf[pos + 3]) << 24)
+
+            # Timestamp, reassembled bitwise. Nanosecond integer in
+            # version 1.1 files, little-endian f64 in version 1.0 files
+            bits = np.uint64(0)
+            for k in range(8):
+                bits |= np.uint64(buf[pos + 4 + k]) << np.uint64(8 * k)
+
+            if ns_timestamps:
+                timestamp = np.float64(bits) * NS_TO_S
+            else:
+                ts_bits[0] = bits
+                timestamp = ts_float[0]
+
+            # Topic length (little-endian u32)
+            topic_len = (int(buf[pos + 12]) | int(buf[pos + 13]) << 8 |
+                         int(buf[pos + 14]) << 16 | int(buf[pos + 15]) << 24)
+
+            offsets[n] = pos
+            timestamps[n] = timestamp
+            topic_lens[n] = topic_len
+            msg_lens[n] = mqtt_len - 8 - 4 - topic_len - 4
+
+            pos += 4 + mqtt_len
+            n += 1
+
+        return n
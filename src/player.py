@@ -1,18 +1,74 @@
+import bisect
+import collections
+import re
 import sys
 import time
 import datetime
+import mmap
+import struct
+import threading
 from pyclbr import Function
 
-from bitstring import ConstBitStream
 from paho.mqtt import client as mqtt
 
+from src import fastparse
+
+# Precompiled 32-bit unsigned integer (little endian)
+_U32 = struct.Struct('<I')
+
+# Number of QoS > 0 publishes between broker confirmation checks
+_PUBLISH_BATCH = 64
+
+
+def _topic_filter_regex(filters: list) -> re.Pattern:
+    """
+    Compiles a list of MQTT topic filters into a single regular expression
+
+    Supports the MQTT wildcards: '+' matches one topic level, a trailing
+    '#' matches the parent level and all levels below it.
+
+    Args:
+        filters (list): MQTT topic filters
+
+    Returns:
+        re.Pattern: Compiled pattern matching any of the filters,
+                    None if the filter list is empty
+    """
+
+    if not filters:
+        return None
+
+    branches = []
+
+    for topic_filter in filters:
+        segments = topic_filter.split('/')
+        parts = []
+
+        for i, segment in enumerate(segments):
+            if segment == '#' and i == len(segments) - 1:
+                if parts:
+                    branches.append('/'.join(parts) + '(?:/.*)?')
+                else:
+                    branches.append('.*')
+                break
+
+            if segment == '+':
+                parts.append('[^/]+')
+            else:
+                parts.append(re.escape(segment))
+        else:
+            branches.append('/'.join(parts))
+
+    return re.compile('^(?:' + '|'.join(branches) + ')$')
+
 
 class MqttPlayer:
     def __init__(self, mqtt_file: str, valid_topics: list,
                  invalid_topics: list, mqtt_client: mqtt,
                  publish: bool = True, callback: Function = None,
-                 cb_user_data: object = None,
-                 quiet: bool = False, info_mode: bool = False) -> None:
+                 cb_user_data: object = None, qos: int = 0,
+                 from_time: float = 0.0, quiet: bool = False,
+                 info_mode: bool = False) -> None:
         """
         MQTT file player. Reads saved MQTT stream and publishes the contents through an MQTT broker
 
@@ -25,8 +81,11 @@ class MqttPlayer:
                                       Defaults to True.
             callback (Function, optional): Optional callback function to call when a 
                                            message is read form the file. Defaults to None.
-            cb_user_data (object, optional): User data to pass to the callback function, optional. 
+            cb_user_data (object, optional): User data to pass to the callback function, optional.
                                              Defaults to None.
+            qos (int, optional): QoS level to publish the messages with. Defaults to 0.
+            from_time (float, optional): Number of seconds into the recording where
+                                         the playback should start. Defaults to 0.
             quiet (bool): If True, the progress messages are not printed
             info_mode(bool): If True, the file is parsed to extract all topics, no actual reading
                              and publishing of the messages is done
@@ -40,12 +99,31 @@ class MqttPlayer:
         self.invalid_topics = invalid_topics
         self.mqtt_client = mqtt_client
 
+        # Topic filters compiled into single regular expressions (None for
+        # an empty list), plus a per-topic verdict cache so each unique
+        # topic in the file is matched only once
+        self._include_re = _topic_filter_regex(valid_topics)
+        self._exclude_re = _topic_filter_regex(invalid_topics)
+        self._accept_cache = {}
+
+        # Entry structs specialized on the topic length, so the whole
+        # fixed-size part of an entry unpacks in a single call. Keyed by
+        # topic length; recordings carry a handful of distinct topics, so
+        # the cache stays tiny and almost always hits
+        self._struct_cache = {}
+
         self.publish = publish
         self.callback = callback
         self.cb_user_data = cb_user_data
+        self.qos = qos
+        self.from_time = from_time
         self.quiet = quiet
 
+        # Outstanding QoS > 0 publishes, confirmed one batch at a time
+        self._inflight = collections.deque(maxlen=_PUBLISH_BATCH)
+
         self.terminate = False
+        self.terminate_event = threading.Event()
         self.first_msg = True
         self.start_time = 0
 
@@ -60,18 +138,14 @@ class MqttPlayer:
             bool: True if topic should be published, False otherwise
         """
 
-        # TODO: This is kind of messy, works though
-        if len(self.valid_topics) > 0:
-            if (topic in self.valid_topics) and (topic not in self.invalid_topics):
-                return True
-            else:
-                return False
+        accept = self._accept_cache.get(topic)
 
-        else:
-            if topic not in self.invalid_topics:
-                return True
-            else:
-                return False
+        if accept is None:
+            accept = (self._exclude_re is None or self._exclude_re.match(topic) is None) and \
+                     (self._include_re is None or self._include_re.match(topic) is not None)
+            self._accept_cache[topic] = accept
+
+        return accept
 
     def reset(self) -> None:
         """
@@ -88,97 +162,271 @@ class MqttPlayer:
             int: 0 if no errors occurred, 1 otherwise
         """
         counter = 0
+        next_print = 0.0
+        elapsed = 0.0
 
         print()
 
-        # Save the starting time
+        # Save the starting time. Shifted back when the playback starts at
+        # an offset into the recording, so message timings stay correct
         if self.first_msg:
-            self.start_time = time.time()
+            self.start_time = time.monotonic() - self.from_time
             self.first_msg = False
 
-        # Open file for reading
+        # Map the file into memory for reading
         try:
-            bitstream = ConstBitStream(filename=self.mqtt_file)
+            with open(self.mqtt_file, 'rb') as fp:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
 
-        except (FileNotFoundError, IOError) as e:
+        except (FileNotFoundError, IOError, ValueError) as e:
             print(f"Could not open MQTT file for reading: {str(e)}", file=sys.stderr)
             exit(1)
 
-        # File header
+        # Playback walks the file front to back, tell the kernel so it
+        # reads ahead aggressively instead of faulting in one page at a
+        # time on a cold cache. Not supported on every platform
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            buf.madvise(mmap.MADV_SEQUENTIAL)
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            buf.madvise(mmap.MADV_WILLNEED)
+
+        # File header: identifier, message count and recording duration
+        # in one unpack. A file shorter than the header is just as invalid
+        # as one with the wrong identifier
         try:
-            file_hdr = bitstream.read('bytes:8').decode('ascii')
-        except UnicodeDecodeError:
-            file_hdr = ''
-
-        if file_hdr != "MQTTv1.0":
+            file_hdr, msg_count, duration = fastparse.FILE_HDR.unpack_from(buf, 0)
+        except struct.error:
+            file_hdr = b''
+
+        # Both format versions are played: version 1.1 stores frame
+        # timestamps as integer nanoseconds, version 1.0 as float seconds
+        if file_hdr == fastparse.FILE_MAGIC:
+            ts_format = 'q'
+            ts_scale = fastparse.NS_TO_S
+        elif file_hdr == fastparse.FILE_MAGIC_V1_0:
+            ts_format = 'd'
+            ts_scale = 1.0
+        else:
             print("Error reading file: unknown file format!", file=sys.stderr)
             return 1
 
         # Total number of messages
-        msg_count = bitstream.read('uintle:64')
         print("Total number of messages in file:", msg_count)
 
         # Duration of the recording
-        duration = bitstream.read('floatle:64')
         duration_str = str(datetime.timedelta(seconds=duration))
         print(f"Total duration of the recording: {duration_str}")
 
+        # Hoisted out of the progress print; also covers a recording whose
+        # header was never finalized and still carries a zero duration
+        inv_duration = 100.0 / duration if duration > 0 else 0.0
+
         if self.info_mode:
             print("\nAnalyzing file", self.mqtt_file, end='\n')
-        else:
-            print("\nPlaying", self.mqtt_file, end='\n\n')
+            return self._show_info(buf, msg_count)
+
+        print("\nPlaying", self.mqtt_file, end='\n\n')
 
-        topic_list = []
+        pos = fastparse.HEADER_SIZE
+        file_len = len(buf)
+        struct_cache = self._struct_cache
+
+        # Jump to the requested starting point in the recording
+        if self.from_time > 0:
+            pos = self._seek_start(buf, msg_count)
 
         # Parse the file
-        while bitstream.pos < bitstream.length and not self.terminate:
+        while pos < file_len and not self.terminate:
 
-            # Read the mqtt entry
-            mqtt_len = bitstream.read('uintle:32')
-            timestamp = bitstream.read('floatle:64')
+            entry_start = pos
 
-            mqtt_bs = ConstBitStream(bitstream.read(f'bytes:{mqtt_len - 8}'))
+            # Peek the topic length, then unpack everything up to the
+            # payload in one call with a struct specialized on it
+            topic_len, = _U32.unpack_from(buf, pos + 12)
 
-            # Read topic name
-            topic_len = mqtt_bs.read('uintle:32')
-            topic = mqtt_bs.read(f'bytes:{topic_len}').decode('iso-8859-15')
+            entry_struct = struct_cache.get(topic_len)
+            if entry_struct is None:
+                entry_struct = struct.Struct(f'<I{ts_format}I{topic_len}sI')
+                struct_cache[topic_len] = entry_struct
 
-            if self.info_mode and topic not in topic_list:
-                topic_list.append(topic)
+            mqtt_len, timestamp, _, topic_bs, msg_len = \
+                entry_struct.unpack_from(buf, pos)
 
-            # Read message data
-            msg_len = mqtt_bs.read('uintle:32')
-            msg = mqtt_bs.read(f'bytes:{msg_len}')
+            topic = topic_bs.decode('iso-8859-15')
 
-            if not self.info_mode:
-                
-                # Only publish topics the user wants to publish
-                if self._is_topic_valid(topic):
+            # Skip entries the user filtered out without ever touching
+            # their payload bytes
+            if not self._is_topic_valid(topic):
+                pos = entry_start + 4 + mqtt_len
+                continue
 
-                    curr_time = time.time() - self.start_time
+            timestamp *= ts_scale
 
-                    # For message time synchronization
-                    while (curr_time < timestamp) and not self.terminate:
-                        curr_time = time.time() - self.start_time
+            # Locate the message data. The payload is sliced out of the map
+            # only after the timing wait below, right before it is needed:
+            # paho insists on bytes (its _encode_payload raises TypeError
+            # for a memoryview), so this one copy cannot be avoided, but at
+            # least a playback stopped mid-wait never pays for it
+            msg_start = pos + entry_struct.size
+            pos = msg_start + msg_len
 
-                        if not self.quiet:
-                            time_str = str(datetime.timedelta(seconds=curr_time))
-                            print(f"{time_str} of {duration_str} ({round(curr_time * 100 / duration, 2):.2f} %)", end='\r')
+            deadline = self.start_time + timestamp
 
-                    counter += 1
+            # For message time synchronization. Messages that are
+            # already due (dense bursts in the recording) skip the
+            # loop and are published back to back without touching
+            # the clock again
+            while timestamp > elapsed and not self.terminate:
+                now = time.monotonic()
+                elapsed = now - self.start_time
+                delay = deadline - now
 
-                    # Publish the message
-                    if self.publish:
-                        self.mqtt_client.publish(topic, msg)
+                if delay <= 0:
+                    break
 
-                    # Run the custom callback function, if specified
-                    if self.callback is not None:
-                        self.callback(msg_count, counter, timestamp, topic, msg, self.cb_user_data)
+                if not self.quiet and now >= next_print:
+                    curr_time = now - self.start_time
 
-        if self.info_mode:
-            print('Topics in file:')
-            for topic in topic_list:
-                print("\t", topic)
+                    # Plain integer divmod, building a datetime.timedelta
+                    # just for its str() is far more expensive
+                    hours, rem = divmod(int(curr_time), 3600)
+                    mins, secs = divmod(rem, 60)
+                    time_str = f"{hours}:{mins:02d}:{secs:02d}"
+
+                    sys.stdout.write(f"\r{time_str} of {duration_str} ({curr_time * inv_duration:.2f} %)")
+                    sys.stdout.flush()
+                    next_print = now + 0.05
+
+                # Sleep off most of the gap, only poll for the last moment.
+                # The event wakes us up immediately if stop() is called.
+                # With progress printing enabled the sleep is chunked so the
+                # progress line keeps ticking through long gaps
+                if delay > 0.001:
+                    wait = delay - 0.0005
+
+                    if not self.quiet:
+                        wait = min(wait, 0.05)
+
+                    self.terminate_event.wait(timeout=wait)
+
+            counter += 1
+
+            msg = buf[msg_start:msg_start + msg_len]
+
+            # Publish the message. For QoS > 0 the broker
+            # confirmations are awaited one batch at a time, so a
+            # single slow acknowledgement does not stall every message
+            if self.publish:
+                msg_info = self.mqtt_client.publish(topic, msg, qos=self.qos)
+
+                if self.qos > 0:
+                    self._inflight.append(msg_info)
+
+                    if len(self._inflight) == _PUBLISH_BATCH:
+                        self._inflight[-1].wait_for_publish(timeout=5.0)
+                        self._inflight.clear()
+
+            # Run the custom callback function, if specified
+            if self.callback is not None:
+                self.callback(msg_count, counter, timestamp, topic, msg, self.cb_user_data)
+
+        # Wait for the confirmations still outstanding
+        if len(self._inflight) > 0:
+            self._inflight[-1].wait_for_publish(timeout=5.0)
+            self._inflight.clear()
+
+        print()
+        print("End of file")
+        return 0
+
+    def _load_index(self, msg_count: int) -> tuple:
+        """
+        Loads the index sidecar of the recording, if a usable one exists
+
+        Args:
+            msg_count (int): Number of messages according to the file header,
+                             used to reject a stale sidecar
+
+        Returns:
+            tuple: Index data as returned by fastparse.load_index,
+                   None if there is no usable index
+        """
+
+        index = fastparse.load_index(self.mqtt_file)
+
+        if index is None:
+            return None
+
+        # Guard against a sidecar left over from a different recording
+        if msg_count > 0 and len(index[1]) != msg_count:
+            return None
+
+        return index
+
+    def _seek_start(self, buf: mmap.mmap, msg_count: int) -> int:
+        """
+        Finds the file offset of the first entry to play when the playback
+        starts at an offset into the recording
+
+        Uses the index sidecar for a binary search when available, otherwise
+        walks the entry headers, skipping over the payloads.
+
+        Args:
+            buf (mmap.mmap): Memory-mapped MQTT file
+            msg_count (int): Number of messages according to the file header
+
+        Returns:
+            int: Offset of the first entry with a timestamp at or after
+                 the requested starting time
+        """
+
+        index = self._load_index(msg_count)
+
+        if index is not None:
+            _, offsets, timestamps, _, _ = index
+
+        else:
+            # No usable sidecar: build the index on the spot with a single
+            # header-only scan of the file
+            offsets, timestamps, _, _ = fastparse.scan(buf)
+
+        i = bisect.bisect_left(timestamps, self.from_time)
+
+        return offsets[i] if i < len(offsets) else len(buf)
+
+    def _show_info(self, buf: mmap.mmap, msg_count: int) -> int:
+        """
+        Prints a summary of the topics found in an MQTT file
+
+        Reads the index sidecar when one is available. Otherwise falls back
+        to the index scan from fastparse, where only the entry headers and
+        topic names are read; the message payloads are never touched.
+
+        Args:
+            buf (mmap.mmap): Memory-mapped MQTT file
+            msg_count (int): Number of messages according to the file header
+
+        Returns:
+            int: 0 if no errors occurred, 1 otherwise
+        """
+
+        index = self._load_index(msg_count)
+
+        if index is not None:
+            topics = set(index[0])
+
+        else:
+            offsets, _, topic_lens, _ = fastparse.scan(buf)
+
+            topics = set()
+
+            for i in range(len(offsets)):
+                topic_start = offsets[i] + fastparse.ENTRY_HDR_SIZE
+                topics.add(buf[topic_start:topic_start + topic_lens[i]].decode('iso-8859-15'))
+
+        print('Topics in file:')
+        for topic in sorted(topics):
+            print("\t", topic)
 
         print()
         print("End of file")
@@ -189,3 +437,4 @@ class MqttPlayer:
         Stops the playback
         """
         self.terminate = True
+        self.terminate_event.set()
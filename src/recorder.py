@@ -1,59 +1,58 @@
+import os
+import queue
 import sys
 import time
 import struct
+import threading
 
 from paho.mqtt import client as mqtt
 
+from src import fastparse
 
-def message_callback(client: mqtt, userdata: dict, message: mqtt.MQTTMessage) -> None:
-    """
-    Callback for MQTT messages
+# Upper bound on the amount of queued data the writer thread
+# coalesces into a single write
+_FLUSH_BYTES = 65536
 
-    Args:
-        client (mqtt): Mqtt client instance
-        userdata (dict): User data passed to MQTT
-        message (mqtt.MQTTMessage): Received messsage
-    """
+# Upper bound on the number of queued entries coalesced into a single
+# write. Must stay within the scatter-gather limit of one writev call
+try:
+    _BATCH_ENTRIES = min(64, os.sysconf('SC_IOV_MAX'))
+except (AttributeError, ValueError, OSError):
+    _BATCH_ENTRIES = 64
 
-    if userdata['first_frame']:
-        userdata['first_frame'] = False
-        userdata['start_time'] = time.time()
+# Default size of the chunks the recording file is preallocated in
+_PREALLOC_BYTES = 16 << 20
 
-    # Encode topic name
-    topic_bs = bytearray(message.topic, 'iso-8859-15')
+# How long the writer thread lets data sit in the buffered file layer
+# on an idle stream before flushing it to disk, in seconds
+_FLUSH_INTERVAL = 0.2
 
-    # Encode message
-    msg_bs = bytearray(message.payload)
+# Precompiled 32-bit unsigned integer (little endian)
+_U32 = struct.Struct('<I')
 
-    # Calculate legths of different message components
-    topic_len = struct.pack('<I', len(topic_bs))
-    msg_len = struct.pack('<I', len(msg_bs))
-
-    # Build MQTT message entry
-    mqtt_bytes = b"".join([topic_len, topic_bs, msg_len, msg_bs])
-
-    timestamp = time.time() - userdata['start_time']
-    timestamp_packed = struct.pack('<d', timestamp)
-
-    mqtt_entry = b"".join([timestamp_packed, mqtt_bytes])
-    mqtt_len = struct.pack('<I', len(mqtt_entry))
-
-    # MQTT message entry header
-    file_data = b"".join([mqtt_len, mqtt_entry])
-
-    # Save the MQTT entry
-    with open(userdata['file'], 'ab') as fp:
-        fp.write(file_data)
-
-    # Append count in user data
-    userdata['count'] += 1
-
-    # Append duration in user data
-    userdata['duration'] = timestamp
+# Prebound methods, saving an attribute lookup per call in the hot callback.
+# Timestamps are taken from the monotonic clock as integer nanoseconds: the
+# clock cannot jump (NTP steps would corrupt message timings) and the
+# integer path is cheaper than a float time.time() call
+_pack_entry_hdr = fastparse.ENTRY_HDR_NS.pack_into
+_pack_u32 = _U32.pack_into
+_pack_idx_rec = fastparse.IDX_REC.pack
+_now = time.monotonic_ns
 
 
 class MqttRecorder:
-    def __init__(self, mqtt_file: str, mqtt_client: mqtt, topics: list) -> None:
+
+    # Every field the message callback touches lives in a fixed slot, so
+    # the per-message attribute accesses are C-level slot lookups instead
+    # of dictionary probes
+    __slots__ = ('mqtt_file', 'prealloc_bytes', 'mqtt_client', 'topics',
+                 'fp', 'entry_queue', 'scratch', 'index', 'topic_info',
+                 'write_pos', 'start_time', 'duration', 'count',
+                 'terminate', 'terminate_event', '_writer_thread',
+                 '_logical_size', '_prealloc_size')
+
+    def __init__(self, mqtt_file: str, mqtt_client: mqtt, topics: list,
+                 prealloc_bytes: int = 0) -> None:
         """
         MQTT recorder class. Monitors MQTT traffic and saves received data to a file
 
@@ -61,23 +60,36 @@ class MqttRecorder:
             mqtt_file (str): Path of the file where to save the data
             mqtt_client (mqtt): Paho MQTT client object instance
             topics (list): List of topics to monitor
+            prealloc_bytes (int, optional): Size of the chunks the recording
+                                            file is preallocated in. Callers
+                                            that know the expected size of the
+                                            recording can pass it here to keep
+                                            the file in as few extents as
+                                            possible. Defaults to 16 MiB chunks.
         """
-        
+
         self.mqtt_file = mqtt_file
+        self.prealloc_bytes = prealloc_bytes or _PREALLOC_BYTES
         self.mqtt_client = mqtt_client
         self.topics = topics
 
-        self.userdata = {
-            'file': mqtt_file,
-            'first_frame': True,
-            'start_time': 0,
-            'duration': 0,
-            'count': 0
-        }
-
-        mqtt_client.user_data_set(self.userdata)
+        self.fp = None
+        self.entry_queue = queue.SimpleQueue()
+        self.scratch = bytearray(4096)
+        self.index = bytearray()
+        self.topic_info = {}
+        self.write_pos = fastparse.HEADER_SIZE
+        self.start_time = 0
+        self.duration = 0
+        self.count = 0
 
         self.terminate = False
+        self.terminate_event = threading.Event()
+        self._writer_thread = None
+
+        # Amount of data actually written vs. space preallocated for it
+        self._logical_size = fastparse.HEADER_SIZE
+        self._prealloc_size = 0
 
     def stop(self):
         """
@@ -85,26 +97,187 @@ class MqttRecorder:
         """
 
         self.terminate = True
+        self.terminate_event.set()
+
+    def _first_message_callback(self, client: mqtt, userdata: object,
+                                message: mqtt.MQTTMessage) -> None:
+        """
+        Callback for the first MQTT message of a recording
+
+        Anchors the recording clock, then rebinds the client callback to
+        the steady-state handler so the first-message check is not paid
+        again on every message that follows.
+
+        Args:
+            client (mqtt): Mqtt client instance
+            userdata (object): User data passed to MQTT (not used)
+            message (mqtt.MQTTMessage): Received messsage
+        """
+
+        self.start_time = _now()
+        self.mqtt_client.on_message = self._message_callback
+        self._message_callback(client, userdata, message)
+
+    def _message_callback(self, client: mqtt, userdata: object,
+                          message: mqtt.MQTTMessage) -> None:
+        """
+        Callback for MQTT messages
+
+        Args:
+            client (mqtt): Mqtt client instance
+            userdata (object): User data passed to MQTT (not used)
+            message (mqtt.MQTTMessage): Received messsage
+        """
+
+        # Encode topic name. Topics repeat for thousands of messages in a
+        # steady stream, so the encoded bytes are cached per topic, alongside
+        # the topic id used by the index sidecar
+        topic_info = self.topic_info
+        info = topic_info.get(message.topic)
+
+        if info is None:
+            info = (len(topic_info), message.topic.encode('iso-8859-15'))
+            topic_info[message.topic] = info
+
+        topic_id, topic_bs = info
+
+        # The payload arrives from paho as bytes already
+        msg_bs = message.payload
+
+        # Calculate legths of different message components
+        topic_len = len(topic_bs)
+        msg_len = len(msg_bs)
+
+        # Entry length covers the timestamp, both length fields and both payloads
+        entry_len = 8 + 4 + topic_len + 4 + msg_len
+        total = 4 + entry_len
+
+        timestamp = _now() - self.start_time
+
+        # Assemble the full entry in a reusable scratch buffer. The buffer is
+        # grown geometrically so it settles at the high-water mark of the
+        # stream instead of being extended a few bytes at a time
+        scratch = self.scratch
+        if len(scratch) < total:
+            scratch.extend(bytes(max(total, 2 * len(scratch)) - len(scratch)))
+
+        _pack_entry_hdr(scratch, 0, entry_len, timestamp, topic_len)
+        scratch[16:16 + topic_len] = topic_bs
+        _pack_u32(scratch, 16 + topic_len, msg_len)
+        scratch[20 + topic_len:20 + topic_len + msg_len] = msg_bs
+
+        # Add an index record for the sidecar file, which keeps its
+        # timestamps in seconds across format versions
+        self.index += _pack_idx_rec(self.write_pos, timestamp * fastparse.NS_TO_S,
+                                    topic_id, msg_len)
+        self.write_pos += total
+
+        # Hand the finished entry over to the writer thread. The network thread
+        # never touches the disk, so a slow write cannot stall packet reception
+        self.entry_queue.put_nowait(bytes(memoryview(scratch)[:total]))
+
+        self.count += 1
+        self.duration = timestamp
+
+    def _writer(self) -> None:
+        """
+        Writer thread. Drains entries queued by the message callback and
+        writes them to the file in batches, so the disk I/O happens off the
+        MQTT network thread and the write syscalls are amortized over many
+        messages. Exits when the None sentinel is received
+        """
+
+        fp = self.fp
+        entry_queue = self.entry_queue
+
+        # Scatter-gather writes push a whole batch to the kernel in one
+        # syscall with no join copy. Not available on every platform
+        fd = fp.fileno()
+        use_writev = hasattr(os, 'writev')
+
+        terminate = False
+
+        while not terminate:
+            try:
+                entry = entry_queue.get(timeout=_FLUSH_INTERVAL)
+            except queue.Empty:
+                # Stream has gone quiet, make sure nothing is left sitting
+                # in the buffered file layer
+                fp.flush()
+                continue
+
+            if entry is None:
+                break
+
+            batch = [entry]
+            batch_size = len(entry)
+
+            # Coalesce whatever else is already waiting in the queue
+            while batch_size < _FLUSH_BYTES and len(batch) < _BATCH_ENTRIES:
+                try:
+                    entry = entry_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if entry is None:
+                    terminate = True
+                    break
+
+                batch.append(entry)
+                batch_size += len(entry)
+
+            # Grow the preallocated area before the file outruns it, so
+            # appends stay plain data writes with no extent allocation
+            if self._prealloc_size > 0:
+                needed = self._logical_size + batch_size
+
+                if needed > self._prealloc_size:
+                    grow = max(needed - self._prealloc_size, self.prealloc_bytes)
+
+                    try:
+                        os.posix_fallocate(fd, self._prealloc_size, grow)
+                        self._prealloc_size += grow
+                    except OSError:
+                        self._prealloc_size = 0
+
+            if use_writev:
+                os.writev(fd, batch)
+            else:
+                fp.write(b"".join(batch))
+
+            self._logical_size += batch_size
 
     def run(self) -> int:
 
-        # Write file header placeholder
+        # Open the single long-lived handle used for the whole recording and
+        # write the file header placeholder: the header text that identifies
+        # the file, followed by reserved space for the message count and the
+        # recording length in seconds (both filled in when recording stops)
         try:
-            with open(self.mqtt_file, 'wb') as fp:
-                # Write header text that identifies the file
-                fp.write("MQTTv1.0".encode('ascii'))
-
-                # Reserve 8 bytes for number of messages (will be filled later)
-                fp.write(struct.pack('<Q', 0))
+            self.fp = open(self.mqtt_file, 'w+b', buffering=_FLUSH_BYTES)
+            self.fp.write(fastparse.FILE_HDR.pack(fastparse.FILE_MAGIC, 0, 0))
 
-                # Reserve 8 bytes for length of the recoding (in seconds) (will be filled later)
-                fp.write(struct.pack('<d', 0))
+            # Push the header out of the buffered layer before the writer
+            # thread starts appending at the descriptor level
+            self.fp.flush()
 
         except IOError as e:
             print(f"Could not open MQTT file for writing: {str(e)}", file=sys.stderr)
             exit(1)
 
-        self.mqtt_client.on_message = message_callback
+        # Preallocate disk space so the appends do not extend the file one
+        # small write at a time. Not supported everywhere, skipped if missing
+        try:
+            os.posix_fallocate(self.fp.fileno(), 0, self.prealloc_bytes)
+            self._prealloc_size = self.prealloc_bytes
+        except (AttributeError, OSError):
+            self._prealloc_size = 0
+
+        self._writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self._writer_thread.start()
+
+        # The first message swaps this over to the steady-state callback
+        self.mqtt_client.on_message = self._first_message_callback
 
         for topic in self.topics:
             self.mqtt_client.subscribe(topic)
@@ -112,25 +285,56 @@ class MqttRecorder:
         self.mqtt_client.loop_start()
 
         # Block until KeyboardInterrupt
-        while not self.terminate:
-            pass
+        self.terminate_event.wait()
 
         print("Writing file header")
 
-        # Fill missing file header data
-        try:
-            with open(self.mqtt_file, 'r+b') as fp:
+        # Let the writer thread drain the queue and exit
+        self.entry_queue.put(None)
+        self._writer_thread.join()
 
-                # Write number of messages to file header
-                fp.seek(8)
-                fp.write(struct.pack('<Q', self.userdata['count']))
+        # Trim the unused preallocated tail
+        if self._prealloc_size > 0:
+            self.fp.truncate(self._logical_size)
 
-                fp.seek(16)
-                fp.write(struct.pack('<d', self.userdata['duration']))
+        # Fill the missing file header data through the descriptor that is
+        # already open; pwrite does not disturb the append offset
+        try:
+            fp = self.fp
+            fp.flush()
+
+            # Number of messages and recording duration sit back to back in
+            # the header, patch both with a single positioned write. The
+            # duration is tracked in nanoseconds but stored in seconds
+            os.pwrite(fp.fileno(),
+                      struct.pack('<Qd', self.count,
+                                  self.duration * fastparse.NS_TO_S), 8)
+
+            os.fsync(fp.fileno())
+
+            # The recording was write-once, tell the kernel the pages it
+            # accumulated in the cache are not going to be read back, so a
+            # long recording does not evict more useful data on its way out.
+            # Not supported everywhere, skipped if missing
+            try:
+                os.posix_fadvise(fp.fileno(), 0, self._logical_size,
+                                 os.POSIX_FADV_DONTNEED)
+            except (AttributeError, OSError):
+                pass
+
+            fp.close()
         except IOError as e:
-            print(f"Could not open MQTT file for writing: {str(e)}", file=sys.stderr)
+            print(f"Could not write the MQTT file header: {str(e)}", file=sys.stderr)
             exit(1)
 
-        print(f"Logged {self.userdata['count']} messages")
+        # Write the index sidecar so --info and seeking by timestamp do not
+        # need to re-scan the whole recording
+        try:
+            fastparse.write_index(self.mqtt_file, list(self.topic_info),
+                                  self.index, self.count)
+        except IOError as e:
+            print(f"Could not write the index file: {str(e)}", file=sys.stderr)
+
+        print(f"Logged {self.count} messages")
 
         return 0